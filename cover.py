@@ -1,12 +1,27 @@
 """Platform for the BFT cover component."""
+import asyncio
+from datetime import timedelta
+from http import HTTPStatus
 import logging
+from time import monotonic
+from types import MappingProxyType
 
-import requests
+import aiohttp
+import orjson
 import voluptuous as vol
 
 import homeassistant.helpers.config_validation as cv
 from homeassistant.components.cover import CoverDevice, PLATFORM_SCHEMA
-from homeassistant.helpers.event import track_utc_time_change
+from homeassistant.core import callback
+from homeassistant.exceptions import PlatformNotReady
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.dispatcher import (
+    async_dispatcher_connect,
+    async_dispatcher_send,
+)
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
+import homeassistant.util.dt as dt_util
 from homeassistant.const import (
     CONF_DEVICE,
     CONF_USERNAME,
@@ -16,34 +31,63 @@ from homeassistant.const import (
     STATE_CLOSED,
     STATE_OPEN,
     CONF_COVERS,
+    EVENT_HOMEASSISTANT_STOP,
 )
 
 _LOGGER = logging.getLogger(__name__)
 
+# Requests to the dispatcher API keyed by (device_id, variable), with the time
+# they were sent. Shared by all covers so entities pointing to the same
+# automation poll it only once, also when they ask at the same time.
+_VARIABLE_CACHE = {}
+
 ATTR_AVAILABLE = "available"
 ATTR_TIME_IN_STATE = "time_in_state"
 
 DEFAULT_NAME = "BFT"
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+PARTICLE_URL = "https://ucontrol-api.bft-automation.com"
+DISPATCHER_API_URL = "https://ucontrol-dispatcher.bft-automation.com/automations"
+
+STORAGE_KEY = "bft_token"
+STORAGE_VERSION = 1
+
+POLL_INTERVAL = timedelta(seconds=30)
+SIGNAL_UPDATE = "bft_update_{}"
+
+WATCHER_INTERVAL = timedelta(seconds=2)
+WATCHER_SLOW_INTERVAL = timedelta(seconds=5)
+WATCHER_SLOW_AFTER = timedelta(seconds=20)
+
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 0.2
+
+CACHE_TTL = 15
+CACHE_TTL_MOVING = 1
 
 STATE_MOVING = "moving"
 STATE_OFFLINE = "offline"
 STATE_STOPPED = "stopped"
 
-STATES_MAP = {
-    "open": STATE_OPEN,
-    "moving": STATE_MOVING,
-    "closed": STATE_CLOSED,
-    "stopped": STATE_STOPPED,
+# State of a gate at rest, keyed by (fully open, fully closed).
+GATE_STATES = {
+    (False, False): STATE_STOPPED,
+    (False, True): STATE_CLOSED,
+    (True, False): STATE_OPEN,
 }
 
-COVER_SCHEMA = vol.Schema(
-    {
-        vol.Optional(CONF_ACCESS_TOKEN): cv.string,
-        vol.Optional(CONF_DEVICE): cv.string,
-        vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
-        vol.Optional(CONF_PASSWORD): cv.string,
-        vol.Optional(CONF_USERNAME): cv.string,
-    }
+COVER_SCHEMA = vol.All(
+    vol.Schema(
+        {
+            vol.Optional(CONF_ACCESS_TOKEN): cv.string,
+            vol.Optional(CONF_DEVICE): cv.string,
+            vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+            vol.Inclusive(CONF_PASSWORD, "credentials"): cv.string,
+            vol.Inclusive(CONF_USERNAME, "credentials"): cv.string,
+        }
+    ),
+    cv.has_at_least_one_key(CONF_ACCESS_TOKEN, CONF_USERNAME),
 )
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
@@ -51,74 +95,202 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
 )
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the BFT covers."""
-    covers = []
+    session = async_get_clientsession(hass)
     devices = config.get(CONF_COVERS)
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+    stored = await store.async_load() or {}
+    stored_tokens = stored.setdefault(PARTICLE_URL, {})
+    accounts = {}
+    obtained_tokens = {}
+
+    for device_config in devices.values():
+        account = (
+            device_config.get(CONF_ACCESS_TOKEN),
+            device_config.get(CONF_USERNAME),
+            device_config.get(CONF_PASSWORD),
+        )
+        accounts.setdefault(account, []).append(device_config)
 
-    for device_name, device_config in devices.items():
-        args = {
-            "name": device_config.get(CONF_NAME),
-            "device": device_config.get(CONF_DEVICE),
-            "username": device_config.get(CONF_USERNAME),
-            "password": device_config.get(CONF_PASSWORD),
-            "access_token": device_config.get(CONF_ACCESS_TOKEN),
-        }
+    async def async_setup_account(account, device_configs):
+        """Set up all covers sharing the same credentials."""
+        try:
+            return await async_setup_covers(account, device_configs)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+            raise PlatformNotReady("Unable to connect to server: {}".format(ex)) from ex
+
+    async def async_setup_covers(account, device_configs):
+        """Resolve token and device ids, then create the covers."""
+        access_token, username, password = account
+        device_ids = None
+        if access_token is None:
+            access_token = stored_tokens.get(username)
+            if access_token is not None:
+                device_ids = await async_get_device_ids(session, access_token)
+
+            if device_ids is None:
+                access_token = await async_get_token(session, username, password)
+                if access_token is None:
+                    return []
+                obtained_tokens[username] = access_token
+
+        if device_ids is None:
+            device_ids = await async_get_device_ids(session, access_token)
+            if device_ids is None:
+                _LOGGER.error("Access token rejected by the BFT API")
+                return []
+
+        covers = []
+        for device_config in device_configs:
+            device = device_config.get(CONF_DEVICE)
+            if device not in device_ids:
+                _LOGGER.error("BFT device %s not found", device)
+                continue
+
+            args = {
+                "name": device_config.get(CONF_NAME),
+                "device": device,
+                "device_id": device_ids[device],
+                "access_token": access_token,
+            }
+
+            covers.append(BftCover(hass, session, args))
+        return covers
+
+    results = await asyncio.gather(
+        *(
+            async_setup_account(account, device_configs)
+            for account, device_configs in accounts.items()
+        ),
+        return_exceptions=True,
+    )
+
+    if obtained_tokens:
+        stored_tokens.update(obtained_tokens)
+        await store.async_save(stored)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    covers = [cover for account_covers in results for cover in account_covers]
+
+    pollers = {}
+    for cover in covers:
+        pollers.setdefault(cover.device_id, cover)
+    for cover in pollers.values():
+        cover.polls_device = True
+
+    async_add_entities(covers)
+
+    @callback
+    def async_stop_polling(event):
+        """Stop polling the automations."""
+        for cover in pollers.values():
+            cover.async_stop_polling()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_polling)
+
+
+async def async_get_token(session, username, password):
+    """Get a new token from the API."""
+    args = {
+        "grant_type": "password",
+        "username": username,
+        "password": password,
+    }
+    url = "{}/oauth/token".format(PARTICLE_URL)
+    async with session.post(
+        url,
+        auth=aiohttp.BasicAuth("particle", "particle"),
+        data=args,
+        timeout=DEFAULT_TIMEOUT,
+    ) as ret:
+        data = await ret.json(loads=orjson.loads)
+
+    try:
+        return data["access_token"]
+    except (KeyError, TypeError):
+        _LOGGER.error("Unable to retrieve access token for %s", username)
+
+
+async def async_get_device_ids(session, access_token):
+    """Get the device ids of all automations, keyed by name.
+
+    Return None if the API rejects the access token.
+    """
+    url = "{}/api/v1/users/?access_token={}".format(PARTICLE_URL, access_token)
+    async with session.get(url, timeout=DEFAULT_TIMEOUT) as ret:
+        if ret.status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            ret.raise_for_status()
+        if ret.status != HTTPStatus.OK:
+            return None
+        data = await ret.json(loads=orjson.loads)
 
-        covers.append(BftCover(hass, args))
+    try:
+        automations_list = data["data"]["automations"]
+    except (KeyError, TypeError):
+        return None
 
-    add_entities(covers)
+    device_ids = {}
+    for automations in automations_list:
+        _LOGGER.debug("UUID: %s", automations["uuid"])
+        _LOGGER.debug("Device Name: %s", automations["info"]["name"])
+        device_ids[automations["info"]["name"]] = automations["uuid"]
+    return device_ids
 
 
 class BftCover(CoverDevice):
     """Representation of a BFT cover."""
 
-    def __init__(self, hass, args):
+    def __init__(self, hass, session, args):
         """Initialize the cover."""
-        self.particle_url = "https://ucontrol-api.bft-automation.com"
-        self.dispatcher_api_url = (
-            "https://ucontrol-dispatcher.bft-automation.com/automations"
-        )
         self.hass = hass
+        self._session = session
         self._name = args["name"]
         self.device_name = args["device"]
-        self.device_id = None
+        self.device_id = args["device_id"]
         self.access_token = args["access_token"]
-        self.obtained_token = False
-        self._username = args["username"]
-        self._password = args["password"]
+        self._headers = MappingProxyType(
+            {"Authorization": "Bearer " + self.access_token}
+        )
+        self._exec_url = "{}/{}/execute/".format(DISPATCHER_API_URL, self.device_id)
         self._state = None
+        self._target_state = None
         self.time_in_state = None
         self._unsub_listener_cover = None
-        self._available = True
-
-        if self.access_token is None:
-            self.access_token = self.get_token()
-            self._obtained_token = True
-
-        if self.device_id is None:
-            self.device_id = self.get_device_id()
-
-        try:
-            self.update()
-        except requests.exceptions.ConnectionError as ex:
-            _LOGGER.error("Unable to connect to server: %(reason)s", dict(reason=ex))
-            self._state = STATE_OFFLINE
-            self._available = False
-            self._name = DEFAULT_NAME
-        except KeyError:
-            _LOGGER.warning(
-                "BFT device %(device)s seems to be offline", dict(device=self.device_id)
+        self._watcher_started = None
+        self._watcher_interval = None
+        self._unsub_dispatcher = None
+        self._unsub_poll = None
+        self.polls_device = False
+        self._update_lock = asyncio.Lock()
+        self._available = False
+
+    async def async_added_to_hass(self):
+        """Subscribe to status updates and fetch the initial state."""
+        self._unsub_dispatcher = async_dispatcher_connect(
+            self.hass, SIGNAL_UPDATE.format(self.device_id), self._async_receive_status
+        )
+        if self.polls_device:
+            self._unsub_poll = async_track_time_interval(
+                self.hass, self._async_poll_device, POLL_INTERVAL
             )
-            self._name = DEFAULT_NAME
-            self._state = STATE_OFFLINE
-            self._available = False
-
-    def __del__(self):
-        """Try to remove token."""
-        if self._obtained_token is True:
-            if self.access_token is not None:
-                self.remove_token()
+        self.async_schedule_update_ha_state(True)
+
+    async def async_will_remove_from_hass(self):
+        """Unsubscribe from status updates of the automation."""
+        self.async_stop_polling()
+        if self._unsub_dispatcher is not None:
+            self._unsub_dispatcher()
+            self._unsub_dispatcher = None
+
+    @callback
+    def async_stop_polling(self):
+        """Stop polling the automation."""
+        if self._unsub_poll is not None:
+            self._unsub_poll()
+            self._unsub_poll = None
 
     @property
     def name(self):
@@ -127,8 +299,8 @@ class BftCover(CoverDevice):
 
     @property
     def should_poll(self):
-        """No polling needed for a demo cover."""
-        return True
+        """No polling needed, status updates are dispatched per automation."""
+        return False
 
     @property
     def available(self):
@@ -155,97 +327,146 @@ class BftCover(CoverDevice):
             return None
         return self._state == STATE_CLOSED
 
+    @property
+    def is_opening(self):
+        """Return if the cover is opening."""
+        return self._state == STATE_MOVING and self._target_state == STATE_OPEN
+
+    @property
+    def is_closing(self):
+        """Return if the cover is closing."""
+        return self._state == STATE_MOVING and self._target_state == STATE_CLOSED
+
     @property
     def device_class(self):
         """Return the class of this device, from component DEVICE_CLASSES."""
         return "door"
 
-    def get_token(self):
-        """Get new token for usage during this session."""
-        args = {
-            "grant_type": "password",
-            "username": self._username,
-            "password": self._password,
-        }
-        url = "{}/oauth/token".format(self.particle_url)
-        ret = requests.post(url, auth=("particle", "particle"), data=args, timeout=10)
-
-        try:
-            return ret.json()["access_token"]
-        except KeyError:
-            _LOGGER.error("Unable to retrieve access token %s")
-
-    def get_device_id(self):
-        """Get device id from name."""
-        url = "{}/api/v1/users/?access_token={}".format(
-            self.particle_url, self.access_token
-        )
-        ret = requests.get(url, timeout=10)
-        for automations in ret.json()["data"]["automations"]:
-            if automations["info"]["name"] == self.device_name:
-                _LOGGER.debug("UUID: %s" % automations["uuid"])
-                _LOGGER.debug("Device Name: %s" % automations["info"]["name"])
-                return automations["uuid"]
-
-    def remove_token(self):
-        """Remove authorization token from API."""
-        url = "{}/v1/access_tokens/{}".format(self.particle_url, self.access_token)
-        ret = requests.delete(url, auth=(self._username, self._password), timeout=10)
-        return ret.text
-
     def _start_watcher(self, command):
         """Start watcher."""
         _LOGGER.debug("Starting Watcher for command: %s ", command)
         if self._unsub_listener_cover is None:
-            self._unsub_listener_cover = track_utc_time_change(
-                self.hass, self._check_state
-            )
+            self._watcher_started = dt_util.utcnow()
+            self._track_state(WATCHER_INTERVAL)
+
+    def _track_state(self, interval):
+        """Check the state every interval."""
+        self._watcher_interval = interval
+        self._unsub_listener_cover = async_track_time_interval(
+            self.hass, self._check_state, interval
+        )
 
-    def _check_state(self, now):
+    def _stop_watcher(self):
+        """Stop watcher."""
+        if self._unsub_listener_cover is not None:
+            self._unsub_listener_cover()
+            self._unsub_listener_cover = None
+
+    async def _check_state(self, now):
         """Check the state of the service during an operation."""
-        self.schedule_update_ha_state(True)
+        await self.async_update()
+        self.async_write_ha_state()
+
+        if (
+            self._unsub_listener_cover is not None
+            and self._watcher_interval == WATCHER_INTERVAL
+            and now - self._watcher_started >= WATCHER_SLOW_AFTER
+        ):
+            self._stop_watcher()
+            self._track_state(WATCHER_SLOW_INTERVAL)
 
-    def close_cover(self, **kwargs):
+    async def async_close_cover(self, **kwargs):
         """Close the cover."""
         if self._state not in ["close"]:
-            ret = self._put_command("close")
-            self._start_watcher("close")
+            ret = await self._send_command("close", STATE_MOVING, STATE_CLOSED)
             return ret.get("status") == "done"
 
-    def open_cover(self, **kwargs):
+    async def async_open_cover(self, **kwargs):
         """Open the cover."""
         if self._state not in ["open"]:
-            ret = self._put_command("open")
-            self._start_watcher("open")
+            ret = await self._send_command("open", STATE_MOVING, STATE_OPEN)
             return ret.get("status") == "done"
 
-    def stop_cover(self, **kwargs):
+    async def async_stop_cover(self, **kwargs):
         """Stop the door where it is."""
         if self._state not in ["stopped"]:
-            ret = self._put_command("stop")
-            self._start_watcher("stop")
+            ret = await self._send_command("stop", STATE_STOPPED)
             return ret["status"] == "done"
 
-    def update(self):
+    async def _send_command(self, command, state, target_state=None):
+        """Send a command, assuming it succeeds until the API reports otherwise."""
+        previous = (self._state, self._target_state)
+        self._set_state(state, target_state)
+        try:
+            ret = await self._put_command(command)
+        except Exception:
+            self._set_state(*previous)
+            raise
+
+        self._start_watcher(command)
+        return ret
+
+    def _set_state(self, state, target_state=None):
+        """Write a state that was not read from the API."""
+        self._state = state
+        self._target_state = target_state
+        self.async_write_ha_state()
+
+    async def async_update(self):
         """Get updated status from API."""
+        if self._update_lock.locked():
+            return
+
+        async with self._update_lock:
+            self._update_from_status(await self._async_get_status())
+
+    async def _async_poll_device(self, now):
+        """Poll the automation and dispatch its status to all its covers."""
         try:
-            status = self._get_variable("diagnosis")
-            self._state = self._get_gate_status(status)
-            _LOGGER.debug(self._state)
-            self._available = True
-        except requests.exceptions.ConnectionError as ex:
-            _LOGGER.error("Unable to connect to server: %(reason)s", dict(reason=ex))
-            self._state = STATE_OFFLINE
-        except KeyError:
-            _LOGGER.warning(
-                "BFT device %(device)s seems to be offline", dict(device=self.device_id)
-            )
+            status = await self._async_get_status()
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Unexpected error polling BFT device %s", self.device_id)
+            return
+        async_dispatcher_send(self.hass, SIGNAL_UPDATE.format(self.device_id), status)
+
+    @callback
+    def _async_receive_status(self, status):
+        """Update the state from a dispatched status."""
+        self._update_from_status(status)
+        self.async_write_ha_state()
+
+    async def _async_get_status(self):
+        """Get the diagnosis of the automation, None if unreachable."""
+        for attempt in range(RETRY_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                return await self._get_variable("diagnosis")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as ex:
+                reason = ex
+
+        _LOGGER.error("Unable to connect to server: %(reason)s", dict(reason=reason))
+        return None
+
+    def _update_from_status(self, status):
+        """Update the state from the diagnosis of the automation."""
+        if status is None:
             self._state = STATE_OFFLINE
+        else:
+            try:
+                self._state = self._get_gate_status(status)
+                _LOGGER.debug("Current State: %s", self._state)
+                self._available = True
+            except KeyError:
+                _LOGGER.warning(
+                    "BFT device %(device)s seems to be offline",
+                    dict(device=self.device_id),
+                )
+                self._state = STATE_OFFLINE
 
         if self._state not in [STATE_MOVING]:
-            if self._unsub_listener_cover is not None:
-                self._unsub_listener_cover()
-                self._unsub_listener_cover = None
+            self._target_state = None
+            self._stop_watcher()
 
     def _get_gate_status(self, status):
         """Get gate status from position and velocity."""
@@ -255,40 +476,43 @@ class BftCover(CoverDevice):
         first_engine_vel_int = status["first_engine_vel_int"]
         second_engine_vel_int = status["second_engine_vel_int"]
 
-        if (
-            (first_engine_pos_int == 100 and second_engine_pos_int == 100)
-            and (first_engine_vel_int == 0 and second_engine_vel_int == 0)
-        ):
-            _LOGGER.warning("open")
-            return STATES_MAP.get("open", None)
-        if (
-            (first_engine_vel_int == 0 and second_engine_vel_int == 0)
-            and (first_engine_pos_int > 0 or second_engine_pos_int > 0)
-        ):
-            _LOGGER.warning("stopped")
-            return STATES_MAP.get("stopped", None)
-        if (
-            (first_engine_pos_int == 0 and second_engine_pos_int == 0)
-            and (first_engine_vel_int == 0 and second_engine_vel_int == 0)
-        ):
-            _LOGGER.warning("closed")
-            return STATES_MAP.get("closed", None)
         if first_engine_vel_int > 0 or second_engine_vel_int > 0:
-            _LOGGER.warning("moving")
-            return STATES_MAP.get("moving", None)
-
-    def _get_variable(self, var):
+            return STATE_MOVING
+        if first_engine_vel_int == 0 and second_engine_vel_int == 0:
+            return GATE_STATES[
+                first_engine_pos_int == 100 and second_engine_pos_int == 100,
+                first_engine_pos_int == 0 and second_engine_pos_int == 0,
+            ]
+
+    async def _get_variable(self, var):
         """Get latest status."""
-        api_call_headers = {"Authorization": "Bearer " + self.access_token}
-        url = "{}/{}/execute/{}".format(self.dispatcher_api_url, self.device_id, var)
-        _LOGGER.debug(url)
-        ret = requests.get(url, timeout=10, headers=api_call_headers)
-        return ret.json()
+        key = (self.device_id, var)
+        ttl = CACHE_TTL_MOVING if self._state == STATE_MOVING else CACHE_TTL
+        cached = _VARIABLE_CACHE.get(key)
+        if cached is None or (cached[1].done() and monotonic() - cached[0] >= ttl):
+            cached = (monotonic(), self.hass.async_create_task(self._call(var)))
+            _VARIABLE_CACHE[key] = cached
+
+        request = cached[1]
+        try:
+            return await asyncio.shield(request)
+        except Exception:
+            if _VARIABLE_CACHE.get(key) is cached:
+                del _VARIABLE_CACHE[key]
+            raise
 
-    def _put_command(self, func):
+    async def _put_command(self, func):
         """Send commands to API."""
-        api_call_headers = {"Authorization": "Bearer " + self.access_token}
-        url = "{}/{}/execute/{}".format(self.dispatcher_api_url, self.device_id, func)
+        value = await self._call(func)
+        for key in [key for key in _VARIABLE_CACHE if key[0] == self.device_id]:
+            del _VARIABLE_CACHE[key]
+        return value
+
+    async def _call(self, path):
+        """Execute a variable read or command on the dispatcher API."""
+        url = self._exec_url + path
         _LOGGER.debug(url)
-        ret = requests.get(url, timeout=10, headers=api_call_headers)
-        return ret.json()
+        async with self._session.get(
+            url, headers=self._headers, timeout=DEFAULT_TIMEOUT
+        ) as ret:
+            return await ret.json(loads=orjson.loads)